@@ -0,0 +1,27 @@
+"""
+Re-save pickled models with joblib so they can be memory-mapped.
+
+joblib stores numpy arrays as separate buffers that load_model() maps with
+mmap_mode='r', letting every API worker share one copy in the page cache.
+Keep the resulting files on local disk; memory-mapping over NFS does not
+share pages reliably.
+
+Each <name>.joblib gets a <name>.joblib.sha256 file holding the hash of the
+.pkl it came from, so load_model() can tell when the .pkl was retrained.
+The .joblib files are not committed; run this in the deploy step.
+
+Run using: python convert_models.py
+"""
+import joblib
+from model_loader import file_sha256
+
+# XGBoost keeps its trees in a raw byte buffer that cannot be memory-mapped,
+# so only models backed by numpy arrays are converted
+MODELS = ["model", "vectorizer"]
+
+for name in MODELS:
+    model = joblib.load(f"{name}.pkl")
+    joblib.dump(model, f"{name}.joblib")
+    with open(f"{name}.joblib.sha256", "w") as f:
+        f.write(file_sha256(f"{name}.pkl"))
+    print(f"✅ {name}.pkl converted to {name}.joblib")
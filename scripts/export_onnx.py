@@ -0,0 +1,41 @@
+"""
+Export the spam detection classifier to ONNX for faster inference.
+
+Only the final estimator of the spam pipeline is converted. Text is
+still vectorized by the pipeline's fitted TF-IDF step in unified_api.py,
+so tokenization is identical to training and ONNX Runtime only sees the
+numeric feature matrix.
+
+model.onnx is not committed; generate it as part of deployment, after the
+model files are in place. The API checks it against the spam pipeline at
+startup and ignores it if they disagree.
+
+Requires: pip install skl2onnx onnxruntime
+Run using: python export_onnx.py
+"""
+import onnxruntime as ort
+from skl2onnx import convert_sklearn
+from skl2onnx.common.data_types import FloatTensorType
+from model_loader import load_model, onnx_matches_pipeline
+
+# Load the same file the API does (model.joblib if present, else model.pkl)
+pipeline = load_model("model")
+
+vectorizer = pipeline[:-1]
+classifier = pipeline[-1]
+n_features = len(vectorizer[-1].vocabulary_)
+
+onnx_model = convert_sklearn(
+    classifier,
+    initial_types=[("input", FloatTensorType([None, n_features]))],
+    options={id(classifier): {"zipmap": False}},
+)
+with open("model.onnx", "wb") as onnx_file:
+    onnx_file.write(onnx_model.SerializeToString())
+
+# Verify the exported model agrees with the original pipeline
+session = ort.InferenceSession("model.onnx", providers=["CPUExecutionProvider"])
+if not onnx_matches_pipeline(session, pipeline):
+    raise SystemExit("❌ model.onnx predictions differ from the spam pipeline")
+
+print("✅ Spam detection model exported to model.onnx")
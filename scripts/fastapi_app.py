@@ -20,10 +20,11 @@ def home():
 def predict_grievance(description: str):
     # Preprocess & Vectorize
     description_cleaned = description.lower()
-    description_vectorized = vectorizer.transform([description_cleaned]).toarray()
+    description_vectorized = vectorizer.transform([description_cleaned])
     
-    # Predict Category (Numerical)
-    numeric_prediction = model.predict(description_vectorized)[0]
+    # Predict Category (Numerical) - DMatrix accepts the sparse matrix as-is
+    predictions = model.predict(xgb.DMatrix(description_vectorized))[0]
+    numeric_prediction = int(np.argmax(predictions)) if predictions.ndim else int(predictions)
     
     # Convert Numeric Label back to Category Name
     category_prediction = label_encoder.inverse_transform([numeric_prediction])[0]
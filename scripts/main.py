@@ -1,23 +1,35 @@
 # pyrefly: ignore [missing-import]
 from fastapi import FastAPI, UploadFile, File, HTTPException
-import pickle
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import uvicorn
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 import google.generativeai as genai
 import os
-from typing import Optional
-import PyPDF2
+from typing import Optional, List, Tuple, Dict, Any
+from pypdf import PdfReader
 import io
 import uuid
+import asyncio
+import json
+import bisect
+import time
+from collections import OrderedDict
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import TfidfVectorizer
+from concurrent.futures import ThreadPoolExecutor
+import anyio.to_thread
 from dotenv import load_dotenv
+from model_loader import load_model
+from redis_client import init_redis, get_redis_client
 
 # Load environment variables from .env file
 load_dotenv()
 
 # Load the trained spam detection model
-with open("model.pkl", "rb") as model_file:
-    model = pickle.load(model_file)
+model = load_model("model")
 
 # Configure Google Gemini API
 # API key is loaded from .env file - make sure to set GEMINI_API_KEY in .env
@@ -29,18 +41,270 @@ else:
     print("⚠️  WARNING: GEMINI_API_KEY not found in environment variables!")
     print("   Please set GEMINI_API_KEY in the .env file")
 
-# Global variable to store PDF content with session management
-pdf_sessions = {}
+gemini_model = genai.GenerativeModel(os.getenv("GEMINI_MODEL", "gemini-3.1-flash-lite"))
 
-app = FastAPI()
+# PDF sessions are stored in Redis so they are shared across workers and expire
+# automatically. Without REDIS_URL, fall back to process memory (single worker only),
+# holding at most PDF_LOCAL_MAX_SESSIONS sessions and evicting the oldest first.
+PDF_SESSION_TTL_SECONDS = int(os.getenv("PDF_SESSION_TTL_SECONDS", "3600"))
+PDF_LOCAL_MAX_SESSIONS = int(os.getenv("PDF_LOCAL_MAX_SESSIONS", "50"))
+# session_id -> (expires_at, index), oldest first
+_local_pdf_sessions = OrderedDict()
+
+# Only this many tokens of PDF text are sent to Gemini with each question
+PDF_CONTEXT_TOKENS = int(os.getenv("PDF_CONTEXT_TOKENS", "2500"))
+# PDFs are split into chunks of about this many characters; the chunks most
+# relevant to each question are sent to Gemini. Text past the last chunk is dropped.
+PDF_CHUNK_CHARS = 1000
+PDF_MAX_CHUNKS = 500
+PDF_STOP_WORDS = "english"
+# Tokenizes questions exactly as the per-session TF-IDF tokenizes chunks
+_query_analyzer = TfidfVectorizer(stop_words=PDF_STOP_WORDS).build_analyzer()
+
+# Prompt sent to Gemini is PROMPT_HEADER + PDF context + PROMPT_QUESTION + query + PROMPT_FOOTER
+PROMPT_HEADER = (
+    "Based on the following PDF content, please answer the question accurately and concisely.\n\n"
+    "PDF Content:\n"
+)
+PROMPT_QUESTION = "\n\nQuestion: "
+PROMPT_FOOTER = "\n\nPlease provide a clear and helpful answer based only on the information in the PDF."
+# Rough characters-per-token ratios: an upper bound used before counting,
+# and an estimate used when tokens can't be counted
+MAX_CHARS_PER_TOKEN = 8
+AVG_CHARS_PER_TOKEN = 4
+
+# /ask_batch question limit, and Gemini calls in flight at once per worker
+MAX_BATCH_QUESTIONS = 50
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "20"))
+# Shared by every endpoint in this worker to avoid Gemini rate-limit bursts
+gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+# Uploads larger than this are rejected before parsing
+PDF_MAX_UPLOAD_BYTES = int(os.getenv("PDF_MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+PDF_READ_CHUNK_BYTES = 1024 * 1024
+
+# Upper bound on threads used to extract text from a single PDF
+PDF_EXTRACT_WORKERS = min(8, os.cpu_count() or 1)
+
+def _extract_page_range(pdf_bytes: bytes, start: int, stop: int) -> List[str]:
+    """Extract text from pages [start, stop) using a reader private to this thread"""
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+def extract_pdf_text(pdf_bytes: bytes) -> Tuple[int, str]:
+    """Return the page count and extracted text of a PDF.
+
+    Pages are split into contiguous ranges and extracted in parallel. Each
+    thread opens its own reader since pypdf readers share a single stream
+    and are not safe to use concurrently.
+    """
+    page_count = len(PdfReader(io.BytesIO(pdf_bytes)).pages)
+    workers = max(1, min(PDF_EXTRACT_WORKERS, page_count))
+    step = -(-page_count // workers) if page_count else 1
+    ranges = [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        parts = executor.map(lambda r: _extract_page_range(pdf_bytes, *r), ranges)
+        texts = [text for part in parts for text in part]
+    
+    return page_count, "\n".join(texts)
+
+def split_into_chunks(text: str, size: int = PDF_CHUNK_CHARS) -> List[str]:
+    """Split text into chunks of at most size characters, breaking on whitespace where possible"""
+    chunks = []
+    start = 0
+    while start < len(text) and len(chunks) < PDF_MAX_CHUNKS:
+        end = min(start + size, len(text))
+        if end < len(text):
+            boundary = max(text.rfind(" ", start, end), text.rfind("\n", start, end))
+            if boundary > start:
+                end = boundary
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        start = end
+    return chunks
+
+def build_pdf_index(text: str, chars_per_token: float) -> Dict[str, Any]:
+    """Chunk the PDF text and precompute a TF-IDF matrix over the chunks.
+
+    The index is built once per upload; each question then only needs to
+    vectorize the query and take a dot product against the stored matrix.
+    If the whole text fits in the context, the prompt prefix is built here instead.
+    The index holds only plain data (strings, numbers, numpy arrays) so it
+    can be stored in Redis without pickle.
+    """
+    chunks = split_into_chunks(text)
+    context_chars = int(PDF_CONTEXT_TOKENS * chars_per_token)
+    index = {
+        "has_content": bool(chunks),
+        "prompt_prefix": None,
+        "chunks": [],
+        "vocabulary": [],
+        "context_chars": context_chars,
+        "idf": None,
+        "matrix": None
+    }
+    
+    # Small PDFs fit in the context whole, so every question gets the same
+    # prompt prefix and no retrieval index is needed
+    if chunks and sum(len(chunk) for chunk in chunks) <= context_chars:
+        index["prompt_prefix"] = PROMPT_HEADER + "\n".join(chunks) + PROMPT_QUESTION
+        return index
+    
+    index["chunks"] = chunks
+    if chunks:
+        try:
+            vectorizer = TfidfVectorizer(stop_words=PDF_STOP_WORDS, dtype=np.float32)
+            index["matrix"] = vectorizer.fit_transform(chunks).tocsr()
+            # Feature names are sorted, so column i is vocabulary[i]
+            index["vocabulary"] = vectorizer.get_feature_names_out().tolist()
+            index["idf"] = vectorizer.idf_.astype(np.float32)
+        except ValueError:
+            # Chunks contain only stop words or no word characters at all
+            pass
+    
+    return index
+
+def select_context(index: Dict[str, Any], query: str) -> str:
+    """Return the chunks most similar to the query that fit in the context budget, in document order"""
+    chunks = index["chunks"]
+    order = range(len(chunks))
+    if index["matrix"] is not None:
+        # Rebuild the query's TF-IDF weights from the stored vocabulary and idf
+        vocabulary = index["vocabulary"]
+        weights = {}
+        for term in _query_analyzer(query):
+            i = bisect.bisect_left(vocabulary, term)
+            if i < len(vocabulary) and vocabulary[i] == term:
+                weights[i] = weights.get(i, 0.0) + float(index["idf"][i])
+        if weights:
+            columns = list(weights)
+            scores = index["matrix"][:, columns] @ np.fromiter(weights.values(), dtype=np.float32)
+            # Stable sort keeps document order among equally relevant chunks
+            order = np.argsort(-scores, kind="stable")
+    
+    selected, used_chars = [], 0
+    for i in order:
+        if selected and used_chars + len(chunks[i]) > index["context_chars"]:
+            break
+        selected.append(i)
+        used_chars += len(chunks[i])
+    
+    return "\n...\n".join(chunks[i] for i in sorted(selected))
+
+def serialize_pdf_index(index: Dict[str, Any]) -> bytes:
+    """Pack a PDF index as an .npz blob: JSON metadata plus raw numeric arrays"""
+    meta = {key: index[key] for key in ("has_content", "prompt_prefix", "chunks", "vocabulary", "context_chars")}
+    arrays = {"meta": np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8)}
+    if index["matrix"] is not None:
+        matrix = index["matrix"]
+        arrays.update(
+            idf=index["idf"],
+            data=matrix.data,
+            indices=matrix.indices,
+            indptr=matrix.indptr,
+            shape=np.asarray(matrix.shape)
+        )
+    
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+def deserialize_pdf_index(data: bytes) -> Dict[str, Any]:
+    """Unpack a blob written by serialize_pdf_index without unpickling anything"""
+    with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+        index = json.loads(arrays["meta"].tobytes().decode("utf-8"))
+        index["idf"], index["matrix"] = None, None
+        if "data" in arrays.files:
+            index["idf"] = arrays["idf"]
+            index["matrix"] = csr_matrix(
+                (arrays["data"], arrays["indices"], arrays["indptr"]),
+                shape=tuple(arrays["shape"])
+            )
+    return index
+
+async def estimate_chars_per_token(text: str) -> float:
+    """Measure the characters-per-token ratio of the PDF text with Gemini's tokenizer.
+
+    Tokens are counted once here at upload time so questions can size their
+    context without another API call. Falls back to an estimate if counting fails.
+    """
+    sample = text[:PDF_CONTEXT_TOKENS * MAX_CHARS_PER_TOKEN]
+    if not sample.strip() or GEMINI_API_KEY == "your_api_key_here":
+        return AVG_CHARS_PER_TOKEN
+    
+    try:
+        total_tokens = (await gemini_model.count_tokens_async(sample)).total_tokens
+    except Exception as e:
+        print(f"Token counting failed, estimating context size by characters: {e}", flush=True)
+        return AVG_CHARS_PER_TOKEN
+    
+    return len(sample) / max(total_tokens, 1)
+
+async def read_pdf_upload(pdf_file: UploadFile) -> bytes:
+    """Read an uploaded PDF into memory, rejecting it with 413 once it exceeds PDF_MAX_UPLOAD_BYTES"""
+    # Fast path: size is known up front from the upload or its part headers
+    declared_size = pdf_file.size
+    if declared_size is None and pdf_file.headers.get("content-length", "").isdigit():
+        declared_size = int(pdf_file.headers["content-length"])
+    if declared_size is not None and declared_size > PDF_MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="PDF too large")
+    
+    buffer = bytearray()
+    while chunk := await pdf_file.read(PDF_READ_CHUNK_BYTES):
+        buffer.extend(chunk)
+        if len(buffer) > PDF_MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="PDF too large")
+    return bytes(buffer)
+
+async def store_pdf_session(session_id: str, index: Dict[str, Any]):
+    """Save the PDF index under the session ID"""
+    client = get_redis_client(binary=True)
+    if client is None:
+        now = time.monotonic()
+        for expired_id in [sid for sid, (expires_at, _) in _local_pdf_sessions.items() if expires_at <= now]:
+            del _local_pdf_sessions[expired_id]
+        _local_pdf_sessions[session_id] = (now + PDF_SESSION_TTL_SECONDS, index)
+        while len(_local_pdf_sessions) > PDF_LOCAL_MAX_SESSIONS:
+            _local_pdf_sessions.popitem(last=False)
+        return
+    await client.setex(f"pdf:{session_id}:index", PDF_SESSION_TTL_SECONDS, serialize_pdf_index(index))
+
+async def load_pdf_session(session_id: str) -> Optional[Dict[str, Any]]:
+    """Return the PDF index for a session, or None if unknown or expired"""
+    client = get_redis_client(binary=True)
+    if client is None:
+        entry = _local_pdf_sessions.get(session_id)
+        if entry is None:
+            return None
+        expires_at, index = entry
+        if expires_at <= time.monotonic():
+            del _local_pdf_sessions[session_id]
+            return None
+        return index
+    data = await client.get(f"pdf:{session_id}:index")
+    return deserialize_pdf_index(data) if data is not None else None
+
+app = FastAPI(default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173", "http://localhost:5174", "http://localhost:5175", "https://sahay-ai-dbh3.vercel.app","https://sahay-ai.vercel.app"],  # Adjust for your React app
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=86400,  # Cache preflight requests for 24 hours
 )
 
+@app.on_event("startup")
+async def startup_event():
+    # Raise AnyIO's default threadpool limit (40) so offloaded model calls
+    # don't cap throughput under concurrent requests
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = max(64, (os.cpu_count() or 1) * 8)
+    
+    await init_redis()
+
 class GrievanceRequest(BaseModel):
     description: str
 
@@ -48,6 +312,10 @@ class QuestionRequest(BaseModel):
     query: str
     session_id: str
 
+class BatchQuestionRequest(BaseModel):
+    queries: List[str]
+    session_id: str
+
 SPAM_KEYWORDS = [
     "free", "lottery", "winner", "click here", "buy now",
     "subscribe", "offer", "discount", "prize", "congratulations",
@@ -67,7 +335,7 @@ async def predict(request: GrievanceRequest):
                 return {"spam": True}
 
         # ML model check
-        proba = model.predict_proba([description])[0]
+        proba = (await run_in_threadpool(model.predict_proba, [description]))[0]
         spam_confidence = float(proba[1])
         is_spam = spam_confidence >= 0.8
         print(f"Spam confidence: {spam_confidence:.2f} -> {'SPAM' if is_spam else 'LEGIT'}", flush=True)
@@ -80,76 +348,101 @@ async def predict(request: GrievanceRequest):
 @app.post("/init_rag")
 async def init_rag(pdf_files: UploadFile = File(...)):
     """Initialize RAG system with uploaded PDF"""
-    global pdf_sessions
-    
     if not pdf_files.filename.endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
     
+    # Read PDF content, stopping early if it is too large
+    pdf_bytes = await read_pdf_upload(pdf_files)
+    
     try:
-        # Read PDF content
-        pdf_bytes = await pdf_files.read()
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
+        # Extract text from all pages off the event loop
+        page_count, text_content = await run_in_threadpool(extract_pdf_text, pdf_bytes)
+        del pdf_bytes
         
-        # Extract text from all pages
-        text_content = ""
-        for page in pdf_reader.pages:
-            text_content += page.extract_text() + "\n"
+        # Chunk and vectorize once so follow-up questions skip this work
+        chars_per_token = await estimate_chars_per_token(text_content)
+        index = await run_in_threadpool(build_pdf_index, text_content, chars_per_token)
+        del text_content
         
         # Generate a session ID for this PDF
         session_id = str(uuid.uuid4())
         
-        # Store PDF content with session ID
-        pdf_sessions[session_id] = text_content
+        # Store PDF index with session ID
+        await store_pdf_session(session_id, index)
         
         return {
             "message": "PDF processed successfully", 
-            "pages": len(pdf_reader.pages),
+            "pages": page_count,
             "session_id": session_id
         }
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing PDF: {str(e)}")
 
-@app.post("/ask_question")
-async def ask_question(request: QuestionRequest):
-    """Ask a question about the uploaded PDF"""
-    global pdf_sessions
-    
+async def load_question_session(session_id: str) -> Dict[str, Any]:
+    """Return the PDF index for a session, raising if questions can't be answered"""
     # Check if session exists
-    if request.session_id not in pdf_sessions:
+    index = await load_pdf_session(session_id)
+    if index is None:
         raise HTTPException(status_code=400, detail="Invalid session ID. Please upload a PDF first.")
     
-    pdf_content = pdf_sessions[request.session_id]
-    
-    if not pdf_content:
+    if not index["has_content"]:
         raise HTTPException(status_code=400, detail="No PDF content found for this session.")
     
     if GEMINI_API_KEY == "your_api_key_here":
         raise HTTPException(status_code=503, detail="Gemini API key not configured. Please set GEMINI_API_KEY environment variable.")
     
+    return index
+
+async def answer_question(index: Dict[str, Any], query: str) -> str:
+    """Ask Gemini a question about an indexed PDF"""
+    prompt_prefix = index.get("prompt_prefix")
+    if prompt_prefix is None:
+        # Use only the parts of the PDF relevant to the question
+        pdf_content = await run_in_threadpool(select_context, index, query)
+        prompt_prefix = PROMPT_HEADER + pdf_content + PROMPT_QUESTION
+    
+    prompt = prompt_prefix + query + PROMPT_FOOTER
+    
+    # Generate response without blocking the event loop
+    async with gemini_semaphore:
+        response = await gemini_model.generate_content_async(prompt)
+    return response.text
+
+@app.post("/ask_question")
+async def ask_question(request: QuestionRequest):
+    """Ask a question about the uploaded PDF"""
+    index = await load_question_session(request.session_id)
+    
     try:
-        # Initialize Gemini model
-        model_ai = genai.GenerativeModel(os.getenv("GEMINI_MODEL", "gemini-3.1-flash-lite"))
-        
-        # Create prompt with PDF content and user question
-        prompt = f"""
-        Based on the following PDF content, please answer the question accurately and concisely.
-        
-        PDF Content:
-        {pdf_content[:10000]}  # Limit to first 10k characters to avoid token limits
-        
-        Question: {request.query}
-        
-        Please provide a clear and helpful answer based only on the information in the PDF.
-        """
-        
-        # Generate response
-        response = model_ai.generate_content(prompt)
-        
-        return {"answer": response.text}
+        return {"answer": await answer_question(index, request.query)}
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating answer: {str(e)}")
 
+@app.post("/ask_batch")
+async def ask_batch(request: BatchQuestionRequest):
+    """Ask several questions about the uploaded PDF concurrently"""
+    if not request.queries:
+        raise HTTPException(status_code=400, detail="Please provide at least one question.")
+    if len(request.queries) > MAX_BATCH_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_QUESTIONS} questions can be asked at once.")
+    
+    index = await load_question_session(request.session_id)
+    
+    # Answer each question independently so one failure doesn't discard the rest
+    results = await asyncio.gather(
+        *(answer_question(index, query) for query in request.queries),
+        return_exceptions=True
+    )
+    
+    answers = []
+    for query, result in zip(request.queries, results):
+        if isinstance(result, Exception):
+            answers.append({"query": query, "error": f"Error generating answer: {str(result)}"})
+        else:
+            answers.append({"query": query, "answer": result})
+    return {"answers": answers}
+
 if __name__ == "__main__":
     uvicorn.run(app, host="127.0.0.1", port=8000)
@@ -0,0 +1,74 @@
+import os
+import hashlib
+import logging
+import joblib
+import numpy as np
+
+logger = logging.getLogger("sahay_api")
+
+def file_sha256(path: str) -> str:
+    """Return the hex sha256 of a file, read in 1 MB blocks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_model(name: str):
+    """
+    Load a model saved as <name>.joblib or <name>.pkl.
+
+    The .joblib form (written by convert_models.py) is loaded with
+    mmap_mode='r' so its numpy arrays are memory-mapped read-only and
+    shared between worker processes through the page cache.
+    convert_models.py also writes <name>.joblib.sha256 with the hash of the
+    .pkl it was made from; if the current .pkl no longer matches, the
+    .joblib is stale and the .pkl is loaded instead.
+    """
+    joblib_path, pkl_path = f"{name}.joblib", f"{name}.pkl"
+    sha_path = f"{joblib_path}.sha256"
+
+    if os.path.exists(joblib_path):
+        source_sha = None
+        if os.path.exists(sha_path):
+            with open(sha_path) as f:
+                source_sha = f.read().strip()
+
+        if os.path.exists(pkl_path) and source_sha != file_sha256(pkl_path):
+            logger.warning(
+                f"{joblib_path} was not converted from the current {pkl_path} - loading {pkl_path}. "
+                f"Run convert_models.py to regenerate {joblib_path}."
+            )
+        else:
+            logger.info(f"Loading {joblib_path} (memory-mapped)")
+            return joblib.load(joblib_path, mmap_mode="r")
+
+    if os.path.exists(pkl_path):
+        logger.info(f"Loading {pkl_path}")
+        return joblib.load(pkl_path)
+    raise FileNotFoundError(f"{joblib_path} or {pkl_path} not found")
+
+# Texts used to confirm an ONNX export still agrees with its source pipeline
+ONNX_CHECK_TEXTS = [
+    "Water supply has been cut off in my area for 3 days",
+    "Congratulations you won a lottery click here",
+    "Electricity bill overcharged by 500 rupees this month",
+    "Free prize offer, buy now and earn money",
+    "Pension payments for senior citizens are delayed again",
+]
+
+def onnx_matches_pipeline(session, pipeline) -> bool:
+    """
+    Check that an ONNX export of a pipeline's final estimator gives the same
+    probabilities as the pipeline itself on ONNX_CHECK_TEXTS.
+
+    A retrained pipeline keeps the same feature count (max_features), so
+    comparing input shapes alone cannot detect a stale export.
+    """
+    features = pipeline[:-1].transform(ONNX_CHECK_TEXTS).toarray().astype(np.float32)
+    try:
+        onnx_probabilities = session.run(None, {"input": features})[1]
+    except Exception as e:
+        logger.warning(f"ONNX model could not score the check texts: {e}")
+        return False
+    return bool(np.allclose(onnx_probabilities, pipeline.predict_proba(ONNX_CHECK_TEXTS), rtol=1e-4, atol=1e-5))
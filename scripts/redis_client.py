@@ -0,0 +1,86 @@
+import os
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger("sahay_api")
+
+redis_client = None
+redis_binary_client = None
+
+# Keep a stalled Redis from hanging requests; on timeout callers fall back
+# (cache lookups miss, cache writes are skipped)
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "0.1"))
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", "0.5"))
+# Binary values (PDF session indexes) can be a few MB, so allow longer transfers
+REDIS_BINARY_SOCKET_TIMEOUT = float(os.getenv("REDIS_BINARY_SOCKET_TIMEOUT", "1.0"))
+
+async def init_redis():
+    """Connect to Redis if REDIS_URL is configured"""
+    global redis_client, redis_binary_client
+    
+    redis_url = os.getenv("REDIS_URL")
+    if not redis_url:
+        logger.warning("REDIS_URL not provided. Proceeding without Redis (caching will be bypassed).")
+        return None
+    
+    try:
+        import redis.asyncio as redis
+        client = redis.from_url(
+            redis_url,
+            decode_responses=True,
+            socket_timeout=REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=REDIS_CONNECT_TIMEOUT
+        )
+        await client.ping()
+        redis_client = client
+        # Separate client for values that aren't UTF-8 text (e.g. numpy blobs)
+        redis_binary_client = redis.from_url(
+            redis_url,
+            socket_timeout=REDIS_BINARY_SOCKET_TIMEOUT,
+            socket_connect_timeout=REDIS_CONNECT_TIMEOUT
+        )
+        logger.info("Connected to Redis")
+    except Exception as e:
+        logger.error(f"Failed to initialize Redis: {e}")
+        redis_client = None
+        redis_binary_client = None
+    
+    return redis_client
+
+def get_redis_client(binary: bool = False):
+    """Return the Redis client, or None if Redis is not connected.
+
+    The default client decodes responses to str; pass binary=True for a
+    client that returns raw bytes.
+    """
+    return redis_binary_client if binary else redis_client
+
+def cache_key(prefix: str, text: str) -> str:
+    """Build a cache key from a prefix and the normalized input text"""
+    digest = hashlib.sha1(text.strip().lower().encode("utf-8")).hexdigest()
+    return f"{prefix}:{digest}"
+
+async def cache_get(key: str):
+    """Return the cached JSON value for key, or None on miss or error"""
+    client = get_redis_client()
+    if client is None:
+        return None
+    
+    try:
+        cached = await client.get(key)
+        return json.loads(cached) if cached is not None else None
+    except Exception as e:
+        logger.error(f"Redis cache get error: {e}")
+        return None
+
+async def cache_set(key: str, value, expiration_seconds: int = 3600):
+    """Store value as JSON under key; errors are logged and ignored"""
+    client = get_redis_client()
+    if client is None:
+        return
+    
+    try:
+        await client.setex(key, expiration_seconds, json.dumps(value))
+    except Exception as e:
+        logger.error(f"Redis cache set error: {e}")
@@ -1,14 +1,18 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-import joblib
-import pickle
 import numpy as np
 import uvicorn
-from typing import Dict, Any, Optional
+import asyncio
+import anyio.to_thread
+from typing import Dict, Any, Optional, List
 import os
 import logging
 from datetime import datetime
+from model_loader import load_model, onnx_matches_pipeline
+from redis_client import init_redis, cache_key, cache_get, cache_set
 
 # Configure logging
 logging.basicConfig(
@@ -28,7 +32,8 @@ app = FastAPI(
     description="API for grievance classification and spam detection",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    default_response_class=ORJSONResponse
 )
 
 # Add CORS middleware - more permissive configuration
@@ -60,11 +65,23 @@ class CombinedAnalysisResponse(BaseModel):
     category_confidence: Optional[float] = None
     spam_confidence: Optional[float] = None
 
+# Cached predictions expire after this many seconds
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", "3600"))
+
+# Concurrent /classify requests are grouped into batches of up to this size,
+# waiting at most this long for a batch to fill
+CLASSIFY_BATCH_SIZE = 32
+CLASSIFY_BATCH_WAIT_SECONDS = 0.005
+
+classify_queue: Optional[asyncio.Queue] = None
+classify_worker_task: Optional[asyncio.Task] = None
+
 # Initialize model variables
 grievance_classifier = None
 vectorizer = None
 label_encoder = None
 spam_detection_model = None
+spam_onnx_session = None
 
 def load_models():
     """Load all required ML models"""
@@ -75,9 +92,9 @@ def load_models():
         logger.info("Loading grievance classification models...")
         
         # Check if using XGBoost or another model format
-        if os.path.exists("grievance_classifier.pkl"):
-            grievance_classifier = joblib.load("grievance_classifier.pkl")
-            logger.info("Loaded grievance_classifier.pkl")
+        if os.path.exists("grievance_classifier.joblib") or os.path.exists("grievance_classifier.pkl"):
+            grievance_classifier = load_model("grievance_classifier")
+            logger.info("Loaded grievance_classifier")
         elif os.path.exists("grievance_classifier.json"):
             logger.info("Loading grievance_classifier.json with XGBoost")
             import xgboost as xgb
@@ -88,30 +105,17 @@ def load_models():
             raise FileNotFoundError("grievance_classifier.pkl or grievance_classifier.json not found")
         
         # Load vectorizer and label encoder
-        if os.path.exists("vectorizer.pkl"):
-            vectorizer = joblib.load("vectorizer.pkl")
-            logger.info("Loaded vectorizer.pkl")
-        else:
-            logger.error("vectorizer.pkl not found!")
-            raise FileNotFoundError("vectorizer.pkl not found")
-            
-        if os.path.exists("label_encoder.pkl"):
-            label_encoder = joblib.load("label_encoder.pkl")
-            logger.info("Loaded label_encoder.pkl")
-        else:
-            logger.error("label_encoder.pkl not found!")
-            raise FileNotFoundError("label_encoder.pkl not found")
+        vectorizer = load_model("vectorizer")
+        logger.info("Loaded vectorizer")
+        
+        label_encoder = load_model("label_encoder")
+        logger.info("Loaded label_encoder")
         
         # For spam detection
         logger.info("Loading spam detection model...")
-        if os.path.exists("model.pkl"):
-            with open("model.pkl", "rb") as model_file:
-                spam_detection_model = pickle.load(model_file)
-            logger.info("Loaded model.pkl for spam detection")
-        else:
-            logger.error("model.pkl not found!")
-            raise FileNotFoundError("model.pkl not found")
-            
+        spam_detection_model = load_model("model")
+        logger.info("Loaded model for spam detection")
+        
         logger.info("All models loaded successfully")
         return True
     except Exception as e:
@@ -120,13 +124,89 @@ def load_models():
         logger.error(f"Install all dependencies with: pip install -r requirements.txt")
         return False
 
+def load_onnx_session():
+    """
+    Optionally run the spam classifier through ONNX Runtime (see export_onnx.py).
+
+    Called from each worker's startup rather than at import: under
+    gunicorn --preload an InferenceSession created in the master would
+    lose its intra-op thread pool when the workers are forked.
+    """
+    global spam_onnx_session
+    
+    if os.path.exists("model.onnx"):
+        try:
+            import onnxruntime as ort
+            session_options = ort.SessionOptions()
+            # Requests already run in parallel across the threadpool
+            session_options.intra_op_num_threads = int(os.getenv("ONNX_INTRA_OP_THREADS", "1"))
+            session = ort.InferenceSession(
+                "model.onnx",
+                sess_options=session_options,
+                providers=["CPUExecutionProvider"]
+            )
+
+            # model.onnx must have been exported from the loaded spam pipeline
+            if onnx_matches_pipeline(session, spam_detection_model):
+                spam_onnx_session = session
+                logger.info("Loaded model.onnx for spam detection")
+            else:
+                logger.warning(
+                    "model.onnx does not match the loaded spam pipeline - using the pipeline instead. "
+                    "Re-run export_onnx.py."
+                )
+        except Exception as e:
+            spam_onnx_session = None
+            logger.warning(f"Could not load model.onnx, using the pipeline for spam detection: {e}")
+
+# Load models at import time so that `gunicorn --preload` loads them once in
+# the master process and forked workers share the pages copy-on-write
+models_loaded = load_models()
+if not models_loaded:
+    logger.warning("API started with model loading errors - some endpoints may not work correctly")
+
 @app.on_event("startup")
 async def startup_event():
-    """Runs when the API server starts up"""
+    """Runs in each worker process when it starts serving"""
     logger.info("Starting SahayAI API...")
-    success = load_models()
-    if not success:
-        logger.warning("API started with model loading errors - some endpoints may not work correctly")
+    
+    # Model inference is offloaded to AnyIO's threadpool; the default of 40
+    # tokens becomes the throughput ceiling under concurrent requests
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = max(64, (os.cpu_count() or 1) * 8)
+    logger.info(f"Threadpool limit set to {limiter.total_tokens}")
+    
+    # Create thread pools after the fork: XGBoost's OpenMP threads and ONNX
+    # Runtime's intra-op pool don't survive fork()
+    if models_loaded:
+        await run_in_threadpool(load_onnx_session)
+        await run_in_threadpool(warm_up_models)
+    
+    await init_redis()
+    
+    global classify_queue, classify_worker_task
+    classify_queue = asyncio.Queue()
+    classify_worker_task = asyncio.create_task(classify_batch_worker())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the classification batch worker and fail requests still queued"""
+    global classify_queue, classify_worker_task
+    
+    if classify_worker_task is not None:
+        classify_worker_task.cancel()
+        try:
+            await classify_worker_task
+        except asyncio.CancelledError:
+            pass
+        classify_worker_task = None
+    
+    if classify_queue is not None:
+        pending = []
+        while not classify_queue.empty():
+            pending.append(classify_queue.get_nowait())
+        _fail_pending(pending)
+        classify_queue = None
 
 @app.get("/", tags=["Status"])
 def home():
@@ -165,8 +245,135 @@ def test_page():
     from fastapi.responses import HTMLResponse
     return HTMLResponse(content=html_content)
 
+def _do_classify_batch(descriptions: List[str]) -> List[Dict[str, Any]]:
+    """Vectorize and classify a batch of descriptions. Blocking - run in the threadpool."""
+    # The fitted TF-IDF vectorizer lowercases during tokenization already
+    if not getattr(vectorizer, "lowercase", False):
+        descriptions = [d.lower() for d in descriptions]
+    descriptions_vectorized = vectorizer.transform(descriptions)
+    
+    # Get predictions and confidences
+    if hasattr(grievance_classifier, 'predict_proba'):
+        probabilities = grievance_classifier.predict_proba(descriptions_vectorized)
+        prediction_idx = probabilities.argmax(axis=1)
+        confidences = probabilities[np.arange(len(descriptions)), prediction_idx].tolist()
+        category_predictions = label_encoder.inverse_transform(prediction_idx)
+    else:
+        # For a raw XGBoost Booster - DMatrix takes the sparse matrix directly
+        import xgboost as xgb
+        predictions = grievance_classifier.predict(xgb.DMatrix(descriptions_vectorized))
+        if predictions.ndim == 2:
+            # multi:softprob returns one probability per class
+            prediction_idx = predictions.argmax(axis=1)
+            confidences = predictions[np.arange(len(descriptions)), prediction_idx].tolist()
+        else:
+            # multi:softmax returns class indices only
+            prediction_idx = predictions.astype(int)
+            confidences = [None] * len(descriptions)
+        category_predictions = label_encoder.inverse_transform(prediction_idx)
+    
+    return [
+        {
+            "grievance_category": str(category),
+            "confidence_score": confidence
+        }
+        for category, confidence in zip(category_predictions, confidences)
+    ]
+
+def _do_classify(description: str) -> Dict[str, Any]:
+    """Vectorize and classify a single description. Blocking - run in the threadpool."""
+    return _do_classify_batch([description])[0]
+
+def warm_up_models():
+    """
+    Run one throwaway prediction through each model so that lazy
+    initialization (tokenizer regex, XGBoost predictor, BLAS threads)
+    happens at startup rather than on the first real request.
+    """
+    sample = "Water supply has been irregular in our area for a week"
+    try:
+        if grievance_classifier is not None and vectorizer is not None and label_encoder is not None:
+            _do_classify_batch([sample])
+        if spam_detection_model is not None:
+            _do_spam(sample)
+        logger.info("Models warmed up")
+    except Exception as e:
+        logger.warning(f"Model warm-up failed: {e}")
+
+def _fail_pending(batch):
+    """Fail any unresolved futures in batch with a 503"""
+    for _, future in batch:
+        if not future.done():
+            future.set_exception(HTTPException(
+                status_code=503,
+                detail="Grievance classification service is shutting down. Please retry."
+            ))
+
+async def classify_batch_worker():
+    """
+    Coalesce concurrent classification requests into a single model call.
+    
+    Waits for a request, gives others CLASSIFY_BATCH_WAIT_SECONDS to arrive,
+    then classifies up to CLASSIFY_BATCH_SIZE descriptions together and
+    resolves each caller's future with its own row.
+    """
+    while True:
+        batch = [await classify_queue.get()]
+        try:
+            await asyncio.sleep(CLASSIFY_BATCH_WAIT_SECONDS)
+            while len(batch) < CLASSIFY_BATCH_SIZE and not classify_queue.empty():
+                batch.append(classify_queue.get_nowait())
+            
+            results = await run_in_threadpool(_do_classify_batch, [text for text, _ in batch])
+        except asyncio.CancelledError:
+            # Shutting down - don't leave callers of this batch waiting
+            _fail_pending(batch)
+            raise
+        except Exception as e:
+            logger.error(f"Batch classification error: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+        
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+async def classify_batched(description: str) -> Dict[str, Any]:
+    """Classify a description through the batch worker, or directly if it isn't running"""
+    if classify_queue is None:
+        return await run_in_threadpool(_do_classify, description)
+    
+    future = asyncio.get_running_loop().create_future()
+    await classify_queue.put((description, future))
+    return await future
+
+def _do_spam(description: str) -> Dict[str, Any]:
+    """Run spam detection on a description. Blocking - run in the threadpool."""
+    probabilities = None
+    if spam_onnx_session is not None:
+        # Vectorize with the fitted pipeline steps, classify with ONNX Runtime
+        features = spam_detection_model[:-1].transform([description]).toarray().astype(np.float32)
+        probabilities = spam_onnx_session.run(None, {"input": features})[1][0]
+    elif hasattr(spam_detection_model, 'predict_proba'):
+        probabilities = spam_detection_model.predict_proba([description])[0]
+    
+    if probabilities is not None:
+        prediction_idx = int(probabilities.argmax())
+        is_spam = bool(prediction_idx)
+        confidence = float(probabilities[prediction_idx])
+    else:
+        is_spam = bool(spam_detection_model.predict([description])[0])
+        confidence = None
+    
+    return {
+        "is_spam": is_spam,
+        "confidence_score": confidence
+    }
+
 @app.post("/classify", response_model=GrievanceClassificationResponse, tags=["Grievance"])
-def classify_grievance(request: GrievanceRequest):
+async def classify_grievance(request: GrievanceRequest):
     """
     Classify a grievance into one of the predefined categories.
     
@@ -192,29 +399,19 @@ def classify_grievance(request: GrievanceRequest):
             
         logger.info(f"Received classification request: {request.description[:50]}...")
         
-        # Preprocess & Vectorize
-        description_cleaned = request.description.lower()
-        description_vectorized = vectorizer.transform([description_cleaned])
+        # Return cached result for previously seen text
+        key = cache_key("cls", request.description)
+        cached = await cache_get(key)
+        if cached is not None:
+            logger.info(f"Classification cache hit: {cached['grievance_category']}")
+            return cached
         
-        # Get prediction and confidence
-        if hasattr(grievance_classifier, 'predict_proba'):
-            probabilities = grievance_classifier.predict_proba(description_vectorized)
-            prediction_idx = np.argmax(probabilities[0])
-            confidence = float(probabilities[0][prediction_idx])
-            category_prediction = label_encoder.inverse_transform([prediction_idx])[0]
-        else:
-            # For XGBoost or models without predict_proba
-            description_vectorized_array = description_vectorized.toarray()
-            numeric_prediction = grievance_classifier.predict(description_vectorized_array)[0]
-            category_prediction = label_encoder.inverse_transform([numeric_prediction])[0]
-            confidence = None  # XGBoost requires additional steps to get probabilities
-            
-        logger.info(f"Classification result: {category_prediction}")
+        result = await classify_batched(request.description)
+        logger.info(f"Classification result: {result['grievance_category']}")
         
-        return {
-            "grievance_category": category_prediction,
-            "confidence_score": confidence
-        }
+        await cache_set(key, result, CACHE_TTL_SECONDS)
+        
+        return result
     except HTTPException:
         # Re-raise HTTP exceptions
         raise
@@ -223,7 +420,7 @@ def classify_grievance(request: GrievanceRequest):
         raise HTTPException(status_code=500, detail=f"Classification error: {str(e)}")
 
 @app.post("/spam-detect", response_model=SpamDetectionResponse, tags=["Spam"])
-def detect_spam(request: GrievanceRequest):
+async def detect_spam(request: GrievanceRequest):
     """
     Detect whether a grievance text is spam or not.
     
@@ -249,21 +446,19 @@ def detect_spam(request: GrievanceRequest):
             
         logger.info(f"Received spam detection request: {request.description[:50]}...")
         
-        # Make prediction
-        if hasattr(spam_detection_model, 'predict_proba'):
-            probabilities = spam_detection_model.predict_proba([request.description])[0]
-            is_spam = bool(np.argmax(probabilities))
-            confidence = float(probabilities[np.argmax(probabilities)])
-        else:
-            is_spam = bool(spam_detection_model.predict([request.description])[0])
-            confidence = None
-            
-        logger.info(f"Spam detection result: {is_spam}")
+        # Return cached result for previously seen text
+        key = cache_key("spam", request.description)
+        cached = await cache_get(key)
+        if cached is not None:
+            logger.info(f"Spam detection cache hit: {cached['is_spam']}")
+            return cached
         
-        return {
-            "is_spam": is_spam,
-            "confidence_score": confidence
-        }
+        result = await run_in_threadpool(_do_spam, request.description)
+        logger.info(f"Spam detection result: {result['is_spam']}")
+        
+        await cache_set(key, result, CACHE_TTL_SECONDS)
+        
+        return result
     except HTTPException:
         # Re-raise HTTP exceptions
         raise
@@ -272,7 +467,7 @@ def detect_spam(request: GrievanceRequest):
         raise HTTPException(status_code=500, detail=f"Spam detection error: {str(e)}")
 
 @app.post("/analyze", response_model=CombinedAnalysisResponse, tags=["Combined"])
-def analyze_grievance(request: GrievanceRequest):
+async def analyze_grievance(request: GrievanceRequest):
     """
     Perform both classification and spam detection on a grievance.
     
@@ -303,18 +498,31 @@ def analyze_grievance(request: GrievanceRequest):
                 detail="Invalid grievance description. Please provide a more detailed text."
             )
         
-        # Get classification results
-        classification_result = classify_grievance(request)
+        # Return cached result for previously seen text
+        key = cache_key("an", request.description)
+        cached = await cache_get(key)
+        if cached is not None:
+            return cached
         
-        # Get spam detection results
-        spam_result = detect_spam(request)
+        # Run classification and spam detection concurrently
+        classification_result, spam_result = await asyncio.gather(
+            classify_batched(request.description),
+            run_in_threadpool(_do_spam, request.description)
+        )
+        logger.info(
+            f"Combined analysis result: {classification_result['grievance_category']}, "
+            f"spam={spam_result['is_spam']}"
+        )
         
-        return {
+        result = {
             "grievance_category": classification_result["grievance_category"],
             "is_spam": spam_result["is_spam"],
             "category_confidence": classification_result["confidence_score"],
             "spam_confidence": spam_result["confidence_score"]
         }
+        await cache_set(key, result, CACHE_TTL_SECONDS)
+        
+        return result
     except HTTPException:
         # Re-raise HTTP exceptions
         raise